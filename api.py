@@ -0,0 +1,141 @@
+"""医学知识查询 API 服务
+
+为内部服务提供结构化 JSON 接口，与 Gradio 界面共用 app.py 中的查询逻辑、
+数据库连接池和 Bedrock 客户端。
+
+启动方式：
+    uvicorn api:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from app import (AUTO_METHOD, QUERY_METHODS, QueryCancelled, QueryError, close_db_pool, db_pool_stats,
+                 health_status, is_ready, mark_ready, method_stats, run_auto_query, run_query, warm_up_until_ready)
+from config import API_MAX_CONCURRENCY, API_REQUEST_TIMEOUT, WARMUP_ENABLED
+
+app = FastAPI(title="医学知识查询API")
+
+# 查询在线程池中执行，线程数与并发上限一致
+executor = ThreadPoolExecutor(max_workers=API_MAX_CONCURRENCY, thread_name_prefix="query")
+
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+# QueryError.kind 对应的 HTTP 状态码
+ERROR_STATUS = {
+    "invalid": 400,
+    "not_found": 404,
+    "unavailable": 503,
+    "upstream": 502,
+}
+
+class QueryRequest(BaseModel):
+    keyword: str
+    question: str
+    method: str = "nova_cohere"
+    timeout: Optional[float] = None
+    # 仅对 auto 方法有效，为空时使用 ROUTER_HEDGE_ENABLED
+    hedge: Optional[bool] = None
+
+def try_acquire_slot():
+    """占用一个并发槽位，已满时返回 False"""
+    global _inflight
+    with _inflight_lock:
+        if _inflight >= API_MAX_CONCURRENCY:
+            return False
+        _inflight += 1
+        return True
+
+def release_slot(_future=None):
+    global _inflight
+    with _inflight_lock:
+        _inflight -= 1
+
+def inflight_count():
+    with _inflight_lock:
+        return _inflight
+
+def error_response(status_code, message, **headers):
+    return JSONResponse(status_code=status_code, content={"error": message}, headers=headers or None)
+
+async def wait_disconnect(request: Request):
+    """客户端断开连接时返回"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(0.5)
+
+@app.post("/query")
+async def query(body: QueryRequest, request: Request):
+    if body.method not in QUERY_METHODS + [AUTO_METHOD]:
+        return error_response(400, f"不支持的查询方法: {body.method}")
+    if not try_acquire_slot():
+        return error_response(429, "服务繁忙，请稍后重试", **{"Retry-After": "1"})
+
+    timeout = API_REQUEST_TIMEOUT
+    if body.timeout is not None and body.timeout > 0:
+        timeout = min(body.timeout, API_REQUEST_TIMEOUT)
+
+    cancel_event = threading.Event()
+    start = time.perf_counter()
+    try:
+        if body.method == AUTO_METHOD:
+            task = executor.submit(run_auto_query, body.keyword, body.question, body.hedge, cancel_event)
+        else:
+            task = executor.submit(run_query, body.keyword, body.question, body.method, cancel_event)
+    except Exception:
+        release_slot()
+        raise
+    # 槽位在工作线程真正结束后才释放，避免超时后仍在运行的查询绕过限流；
+    # auto 方法对冲产生的额外查询由 ROUTER_HEDGE_WORKERS 限制
+    task.add_done_callback(release_slot)
+    future = asyncio.wrap_future(task)
+
+    disconnect = asyncio.ensure_future(wait_disconnect(request))
+    try:
+        await asyncio.wait({future, disconnect}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not future.done():
+            if disconnect.done():
+                return error_response(499, "客户端已断开")
+            return error_response(504, f"查询超时（{timeout}秒）")
+        try:
+            result = future.result()
+        except QueryError as e:
+            return error_response(ERROR_STATUS.get(e.kind, 500), str(e))
+        except QueryCancelled as e:
+            return error_response(499, str(e))
+        result["timings"]["request"] = round(time.perf_counter() - start, 4)
+        return result
+    finally:
+        disconnect.cancel()
+        # 超时、断开或请求被取消时通知工作线程停止后续的Bedrock调用
+        if not future.done():
+            cancel_event.set()
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+@app.get("/health")
+def health():
+    """预热完成前返回 503，负载均衡器据此决定是否转发流量"""
+    status = health_status()
+    status["inflight"] = inflight_count()
+    status["methods"] = method_stats.snapshot()
+    status["db_pool"] = db_pool_stats()
+    return JSONResponse(status_code=200 if is_ready() else 503, content=status)
+
+@app.on_event("startup")
+def startup():
+    # 在后台线程预热，服务先开始监听以便健康检查返回 warming 状态
+    if WARMUP_ENABLED:
+        threading.Thread(target=warm_up_until_ready, daemon=True).start()
+    else:
+        mark_ready()
+
+@app.on_event("shutdown")
+def shutdown():
+    executor.shutdown(wait=False)
+    close_db_pool()
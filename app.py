@@ -1,11 +1,41 @@
 import gradio as gr
+from fastapi.responses import JSONResponse
 import psycopg2
+import psycopg2.pool
 import boto3
+from botocore.config import Config
 import json
 from config import *
 import numpy as np
 import time
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from router import MethodStats, choose_methods
+
+# 支持的查询方法
+QUERY_METHODS = ["nova_cohere", "nova_titan", "deepseek_cohere"]
+# 自动选择查询方法
+AUTO_METHOD = "auto"
+
+# Deepseek生成失败时返回的提示
+DEEPSEEK_FAILED_MESSAGE = "生成回答失败，请稍后重试"
+
+class QueryError(Exception):
+    """查询失败，message 即返回给用户的提示，kind 用于区分错误类型"""
+
+    def __init__(self, message, kind="error"):
+        super().__init__(message)
+        self.kind = kind
+
+class QueryCancelled(Exception):
+    """查询被调用方取消（超时或客户端断开）"""
+
+def check_cancelled(cancel_event):
+    """在各阶段之间检查取消标记，避免已放弃的请求继续调用Bedrock"""
+    if cancel_event is not None and cancel_event.is_set():
+        raise QueryCancelled("查询已取消")
 
 def create_db_connection():
     try:
@@ -23,20 +53,114 @@ def create_db_connection():
         print(f"数据库连接失败: {str(e)}")
         return None
 
+class DBPool:
+    """线程安全的数据库连接池，连接耗尽时阻塞等待而不是直接报错"""
+
+    def __init__(self, minconn, maxconn):
+        self.maxconn = maxconn
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # 借出和等待中的连接数，用于观察连接池是否饱和
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._waiting = 0
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn,
+            maxconn,
+            host=DB_HOST,
+            port=DB_PORT,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            dbname=DB_NAME,
+            connect_timeout=10
+        )
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """借出一个连接，使用完毕后自动归还"""
+        with self._stats_lock:
+            self._waiting += 1
+        acquired = self._slots.acquire(timeout=timeout)
+        with self._stats_lock:
+            self._waiting -= 1
+            if acquired:
+                self._in_use += 1
+        if not acquired:
+            raise psycopg2.pool.PoolError("等待数据库连接超时")
+        try:
+            conn = self._pool.getconn()
+            broken = False
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+                raise
+            finally:
+                self._pool.putconn(conn, close=broken or conn.closed != 0)
+        finally:
+            with self._stats_lock:
+                self._in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            return {"max": self.maxconn, "in_use": self._in_use, "waiting": self._waiting}
+
+    def close(self):
+        self._pool.closeall()
+
+_db_pool = None
+_clients = None
+_init_lock = threading.Lock()
+
+def get_db_pool():
+    """获取进程内共享的连接池，首次调用时创建"""
+    global _db_pool
+    if _db_pool is None:
+        with _init_lock:
+            if _db_pool is None:
+                _db_pool = DBPool(DB_POOL_MIN, DB_POOL_MAX)
+                print("数据库连接池创建成功")
+    return _db_pool
+
+def close_db_pool():
+    global _db_pool
+    with _init_lock:
+        if _db_pool is not None:
+            _db_pool.close()
+            _db_pool = None
+
+def db_pool_stats():
+    """连接池使用情况，连接池尚未创建时返回 None"""
+    pool = _db_pool
+    return pool.stats() if pool is not None else None
+
 def create_clients():
+    """获取共享的Bedrock客户端（boto3客户端线程安全，进程内只创建一次）"""
+    global _clients
+    if _clients is not None:
+        return _clients
     try:
-        session = boto3.Session(
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-            region_name=AWS_REGION
-        )
-        
-        cohere_client = session.client("bedrock-runtime")
-        nova_client = session.client("bedrock-runtime")
-        titan_client = session.client("bedrock-runtime")
-        deepseek_client = session.client("bedrock-runtime")
-        print("AWS客户端创建成功")
-        return cohere_client, nova_client, titan_client, deepseek_client
+        with _init_lock:
+            if _clients is None:
+                session = boto3.Session(
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    region_name=AWS_REGION
+                )
+                # 读超时防止连接挂起；已开始的生成由 invoke_streaming 在取消时中止
+                client_config = Config(
+                    max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+                    connect_timeout=BEDROCK_CONNECT_TIMEOUT,
+                    read_timeout=BEDROCK_READ_TIMEOUT
+                )
+                client = session.client("bedrock-runtime", config=client_config)
+                _clients = (client, client, client, client)
+                print("AWS客户端创建成功")
+        return _clients
     except Exception as e:
         print(f"AWS客户端创建失败: {str(e)}")
         return None, None, None, None
@@ -44,23 +168,22 @@ def create_clients():
 def search_documents(keyword):
     """根据关键词搜索文档"""
     try:
-        conn = create_db_connection()
-        if not conn:
+        try:
+            pool = get_db_pool()
+        except Exception as e:
+            print(f"数据库连接失败: {str(e)}")
             return "数据库连接失败", None
             
-        cur = conn.cursor()
-        
         query = """
         SELECT id, doc, embedding_doc
         FROM text_embedding
         WHERE doc ILIKE %s
         LIMIT 1000;
         """
-        cur.execute(query, [f'%{keyword}%'])
-        results = cur.fetchall()
-        
-        cur.close()
-        conn.close()
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(query, [f'%{keyword}%'])
+                results = cur.fetchall()
         
         if not results:
             return "未找到相关记录", None
@@ -86,15 +209,46 @@ def rerank_documents(cohere_client, query, documents):
     except Exception as e:
         raise Exception(f"Cohere重排序出错: {str(e)}")
 
-def generate_summary(nova_client, content):
-    """使用Nova生成总结"""
+def invoke_streaming(client, cancel_event, extract_text, **kwargs):
+    """流式调用模型并拼接输出文本
+
+    cancel_event 被设置时关闭事件流，正在进行的生成随之中止并抛出 QueryCancelled。
+    """
+    check_cancelled(cancel_event)
+    stream = client.invoke_model_with_response_stream(**kwargs)["body"]
+    finished = threading.Event()
+    
+    def close_on_cancel():
+        while not finished.is_set():
+            if cancel_event.wait(0.2):
+                stream.close()
+                return
+    
+    watcher = threading.Thread(target=close_on_cancel, daemon=True)
+    watcher.start()
+    parts = []
+    try:
+        for event in stream:
+            chunk = event.get("chunk")
+            if chunk:
+                parts.append(extract_text(json.loads(chunk["bytes"])))
+    except Exception:
+        check_cancelled(cancel_event)
+        raise
+    finally:
+        finished.set()
+        stream.close()
+    check_cancelled(cancel_event)
+    return "".join(parts)
+
+def generate_summary(nova_client, content, cancel_event=None):
+    """使用Nova生成总结，传入 cancel_event 时使用流式调用以便中途取消"""
     try:
         messages = [{
             "role": "user",
             "content": [{"text": f"请根据以下医学相关内容，给出专业的回答：\n\n{content}"}]
         }]
-        
-        response = nova_client.invoke_model(
+        request = dict(
             modelId=NOVA_MODEL_ID,
             contentType="application/json",
             accept="application/json",
@@ -104,8 +258,19 @@ def generate_summary(nova_client, content):
             })
         )
         
+        if cancel_event is not None:
+            return invoke_streaming(
+                nova_client, cancel_event,
+                lambda chunk: chunk.get("contentBlockDelta", {}).get("delta", {}).get("text", ""),
+                **request
+            )
+        
+        response = nova_client.invoke_model(**request)
+        
         response_body = json.loads(response['body'].read().decode('utf-8'))
         return response_body["output"]["message"]["content"][0]["text"]
+    except QueryCancelled:
+        raise
     except Exception as e:
         raise Exception(f"Nova生成总结出错: {str(e)}")
 
@@ -165,8 +330,8 @@ def calculate_similarity(query_embedding, doc_embeddings):
     except Exception as e:
         raise Exception(f"相似度计算失败: {str(e)}")
 
-def generate_deepseek_response(deepseek_client, content, question, max_retries=5):
-    """使用Deepseek生成结构化回答"""
+def generate_deepseek_response(deepseek_client, content, question, max_retries=5, cancel_event=None):
+    """使用Deepseek生成结构化回答，cancel_event 被设置后不再发起新的重试"""
     try:
         # 格式化输入内容
         content_list = content.split('\n\n')
@@ -220,16 +385,25 @@ def generate_deepseek_response(deepseek_client, content, question, max_retries=5
         
         attempt = 0
         while attempt < max_retries:
+            check_cancelled(cancel_event)
             try:
-                response = deepseek_client.invoke_model(
+                request = dict(
                     modelId=DEEPSEEK_MODEL_ID,
                     contentType="application/json",
                     accept="application/json",
                     body=json.dumps(request_body, ensure_ascii=False).encode('utf-8')
                 )
                 
-                response_body = json.loads(response['body'].read().decode('utf-8'))
-                output_text = response_body.get('generation', '')
+                if cancel_event is not None:
+                    output_text = invoke_streaming(
+                        deepseek_client, cancel_event,
+                        lambda chunk: chunk.get('generation', ''),
+                        **request
+                    )
+                else:
+                    response = deepseek_client.invoke_model(**request)
+                    response_body = json.loads(response['body'].read().decode('utf-8'))
+                    output_text = response_body.get('generation', '')
                 
                 if not output_text:
                     print(f"尝试 {attempt + 1}: 未获得有效响应")
@@ -261,6 +435,8 @@ def generate_deepseek_response(deepseek_client, content, question, max_retries=5
                 formatted_output = "分析结果：\n\n" + '\n\n'.join(sections)
                 return formatted_output.strip()
                 
+            except QueryCancelled:
+                raise
             except Exception as e:
                 print(f"尝试 {attempt + 1} 失败: {str(e)}")
             
@@ -268,112 +444,408 @@ def generate_deepseek_response(deepseek_client, content, question, max_retries=5
             if attempt < max_retries:
                 wait_time = min(30, 5 * (2 ** attempt))
                 print(f"等待 {wait_time} 秒后重试...")
-                time.sleep(wait_time)
+                if cancel_event is not None:
+                    cancel_event.wait(wait_time)
+                else:
+                    time.sleep(wait_time)
                 
-        return "生成回答失败，请稍后重试"
+        return DEEPSEEK_FAILED_MESSAGE
             
+    except QueryCancelled:
+        raise
     except Exception as e:
         print(f"Deepseek处理失败: {str(e)}")
         return f"处理出错: {str(e)}"
 
-def process_query(keyword, question, method="nova_cohere"):
-    """处理用户查询"""
+@contextmanager
+def timed(timings, stage):
+    """记录某个阶段的耗时（秒）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 4)
+
+def run_query(keyword, question, method="nova_cohere", cancel_event=None):
+    """执行查询并返回结构化结果
+
+    返回包含文档id、得分、各阶段耗时和最终答案的字典；失败时抛出 QueryError，
+    cancel_event 被设置时在下一个阶段开始前抛出 QueryCancelled。
+    """
     if not keyword or not question:
-        return "请输入关键词和问题"
+        raise QueryError("请输入关键词和问题", kind="invalid")
+    # 排队期间已被取消的查询不再访问数据库
+    check_cancelled(cancel_event)
+    if method == AUTO_METHOD:
+        return run_auto_query(keyword, question, cancel_event=cancel_event)
         
+    timings = {}
     try:
-        # 创建客户端
-        cohere_client, nova_client, titan_client, deepseek_client = create_clients()
-        if not all([cohere_client, nova_client, titan_client, deepseek_client]):
-            return "错误: AWS服务连接失败，请检查AWS凭证配置"
-        
-        # 搜索相关文档
-        status, results = search_documents(keyword)
-        if not results:
-            return f"错误: {status}"
-        
-        # 提取文档内容和嵌入向量
-        documents = [result[1] for result in results]
-        embeddings = [result[2] for result in results]
-        
-        try:
-            search_results = "\n相关性最强的前5条记录：\n"
+        with timed(timings, "total"):
+            # 获取共享客户端
+            cohere_client, nova_client, titan_client, deepseek_client = create_clients()
+            if not all([cohere_client, nova_client, titan_client, deepseek_client]):
+                raise QueryError("错误: AWS服务连接失败，请检查AWS凭证配置", kind="unavailable")
+            
+            # 搜索相关文档
+            with timed(timings, "search"):
+                status, results = search_documents(keyword)
+            if not results:
+                kind = "not_found" if status == "未找到相关记录" else "unavailable"
+                raise QueryError(f"错误: {status}", kind=kind)
+            
+            # 提取文档内容和嵌入向量
+            ids = [result[0] for result in results]
+            documents = [result[1] for result in results]
+            embeddings = [result[2] for result in results]
+            hits = []
             
-            if method == "nova_cohere":
-                # Cohere重排序
-                reranked_results = rerank_documents(cohere_client, question, documents)
-                for result in reranked_results[:5]:
-                    search_results += f"\n记录索引：{result['index']}, 相关性得分：{result['relevance_score']:.4f}\n"
-                    search_results += f"文档内容：{documents[result['index']]}\n"
+            try:
+                check_cancelled(cancel_event)
+                if method == "nova_cohere":
+                    # Cohere重排序
+                    with timed(timings, "rerank"):
+                        reranked_results = rerank_documents(cohere_client, question, documents)
+                    for result in reranked_results[:5]:
+                        hits.append({
+                            "id": ids[result['index']],
+                            "index": result['index'],
+                            "score": result['relevance_score'],
+                            "doc": documents[result['index']]
+                        })
                     
-                top_docs = "\n\n".join([documents[result['index']] for result in reranked_results[:5]])
-                final_answer = generate_summary(nova_client, f"{question}\n\n{top_docs}")
-                
-            elif method == "nova_titan":
-                # Titan嵌入和相似度计算
-                query_embedding = get_titan_embedding(titan_client, question)
-                sorted_indices = calculate_similarity(query_embedding, embeddings)
-                
-                for idx in sorted_indices[:5]:
-                    distance = np.sqrt(np.sum((np.array(json.loads(embeddings[idx].replace("'", "\""))) - np.array(query_embedding)) ** 2))
-                    search_results += f"\n记录索引：{idx}, 距离：{distance:.4f}\n"
-                    search_results += f"文档内容：{documents[idx]}\n"
+                    top_docs = "\n\n".join([hit["doc"] for hit in hits])
+                    check_cancelled(cancel_event)
+                    with timed(timings, "generate"):
+                        final_answer = generate_summary(nova_client, f"{question}\n\n{top_docs}", cancel_event)
                     
-                top_docs = "\n\n".join([documents[idx] for idx in sorted_indices[:5]])
-                final_answer = generate_summary(nova_client, f"{question}\n\n{top_docs}")
-                
-            else:  # deepseek_cohere
-                # Cohere重排序
-                reranked_results = rerank_documents(cohere_client, question, documents)
-                
-                # 构建搜索结果，确保显示前5条
-                search_results = "\n相关文档检索结果：\n"
-                shown_docs = set()
-                result_count = 0
-                
-                for result in reranked_results:
-                    doc = documents[result['index']]
-                    if doc not in shown_docs and result_count < 5:
-                        result_count += 1
-                        shown_docs.add(doc)
-                        search_results += f"\n{result_count}. 相关性得分：{result['relevance_score']:.4f}\n"
-                        search_results += f"   文档内容：{doc}\n"
-                
-                # 使用去重后的前5条文档
-                top_docs = "\n\n".join([doc for doc in shown_docs])
-                final_answer = generate_deepseek_response(deepseek_client, top_docs, question)
-                
-                if not final_answer:
-                    raise Exception("未能获得有效的回答")
+                elif method == "nova_titan":
+                    # Titan嵌入和相似度计算
+                    with timed(timings, "embed"):
+                        query_embedding = get_titan_embedding(titan_client, question)
+                    with timed(timings, "similarity"):
+                        sorted_indices = calculate_similarity(query_embedding, embeddings)
+                    
+                    for idx in sorted_indices[:5]:
+                        distance = np.sqrt(np.sum((np.array(json.loads(embeddings[idx].replace("'", "\""))) - np.array(query_embedding)) ** 2))
+                        hits.append({
+                            "id": ids[idx],
+                            "index": idx,
+                            "score": float(distance),
+                            "doc": documents[idx]
+                        })
+                    
+                    top_docs = "\n\n".join([hit["doc"] for hit in hits])
+                    check_cancelled(cancel_event)
+                    with timed(timings, "generate"):
+                        final_answer = generate_summary(nova_client, f"{question}\n\n{top_docs}", cancel_event)
+                    
+                else:  # deepseek_cohere
+                    # Cohere重排序
+                    with timed(timings, "rerank"):
+                        reranked_results = rerank_documents(cohere_client, question, documents)
+                    
+                    # 去重后保留前5条
+                    shown_docs = set()
+                    for result in reranked_results:
+                        doc = documents[result['index']]
+                        if doc not in shown_docs and len(hits) < 5:
+                            shown_docs.add(doc)
+                            hits.append({
+                                "id": ids[result['index']],
+                                "index": result['index'],
+                                "score": result['relevance_score'],
+                                "doc": doc
+                            })
+                    
+                    top_docs = "\n\n".join([hit["doc"] for hit in hits])
+                    check_cancelled(cancel_event)
+                    with timed(timings, "generate"):
+                        final_answer = generate_deepseek_response(deepseek_client, top_docs, question, cancel_event=cancel_event)
+                    
+                    if not final_answer:
+                        raise Exception("未能获得有效的回答")
+                        
+            except (QueryError, QueryCancelled):
+                raise
+            except Exception as e:
+                raise QueryError(f"{method}处理失败: {str(e)}", kind="upstream")
                 
-                return f"""检索到的相关文档：
-{search_results}
-----------------------------------------
-{final_answer}"""
+    except QueryError as e:
+        if e.kind == "upstream":
+            method_stats.record(method, timings["total"], ok=False)
+        raise
+    except QueryCancelled:
+        raise
+    except Exception as e:
+        raise QueryError(f"处理查询时出错: {str(e)}")
+        
+    method_stats.record(method, timings["total"], ok=is_good_answer(final_answer))
+    return {
+        "keyword": keyword,
+        "question": question,
+        "method": method,
+        "record_count": len(results),
+        "documents": hits,
+        "answer": final_answer,
+        "timings": timings
+    }
+
+def is_good_answer(answer):
+    """Deepseek重试耗尽或出错时返回的是提示文本而不是异常"""
+    return bool(answer) and answer != DEEPSEEK_FAILED_MESSAGE and not answer.startswith("处理出错")
+
+def run_auto_query(keyword, question, hedge=None, cancel_event=None):
+    """自动选择查询方法
+
+    开启对冲时，首选方法超过 ROUTER_HEDGE_DELAY 秒未返回（或已失败）就启动备选方法，
+    返回最先得到的有效回答，并取消另一个查询。对冲线程池已满时不再启动备选方法，
+    没有其他查询在运行时则在当前线程执行。
+    """
+    if hedge is None:
+        hedge = ROUTER_HEDGE_ENABLED
+    primary, fallback = choose_methods(question, method_stats, QUERY_METHODS,
+                                       ROUTER_MAX_FAILURE_RATE, ROUTER_LATENCY_BUDGET)
+    routing = {"requested": AUTO_METHOD, "primary": primary, "fallback": fallback, "hedged": False}
+    
+    if not hedge or fallback is None:
+        result = run_query(keyword, question, primary, cancel_event)
+        result["routing"] = routing
+        return result
+    
+    attempts = {}
+    
+    def launch(method, inline=False):
+        event = threading.Event()
+        started = time.monotonic()
+        if _hedge_slots.acquire(blocking=False):
+            future = _hedge_executor.submit(run_query, keyword, question, method, event)
+            future.add_done_callback(lambda f: _hedge_slots.release())
+        elif inline:
+            routing["hedge_skipped"] = True
+            future = Future()
+            try:
+                future.set_result(run_query(keyword, question, method, cancel_event))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            routing["hedge_skipped"] = True
+            return None
+        attempts[future] = (method, event, started)
+        return future
+    
+    def launched(method):
+        return method in [m for m, _, _ in attempts.values()]
+    
+    def cancel_all():
+        for method, event, _ in attempts.values():
+            event.set()
+    
+    pending = {launch(primary, inline=True)}
+    deadline = time.monotonic() + ROUTER_HEDGE_DELAY
+    last_error = None
+    try:
+        while pending:
+            # 定期醒来检查调用方是否已取消
+            timeout = 0.5
+            if not launched(fallback):
+                timeout = max(0.0, min(timeout, deadline - time.monotonic()))
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            check_cancelled(cancel_event)
             
-            # 其他方法保持原有的输出格式
-            return f"{search_results}\n\n最终答案：\n{final_answer}"
+            for future in done:
+                method = attempts[future][0]
+                try:
+                    result = future.result()
+                except QueryCancelled:
+                    continue
+                except QueryError as e:
+                    # 关键词无结果等与方法无关的错误，换方法也无济于事
+                    if e.kind in ("invalid", "not_found"):
+                        raise
+                    print(f"auto: {method} 失败: {str(e)}")
+                    last_error = e
+                    continue
+                if is_good_answer(result["answer"]):
+                    # 被取消的首选方法不会记录统计，按慢失败记一次，避免路由一直选中它
+                    for loser, (loser_method, _, started) in attempts.items():
+                        if loser_method == primary and not loser.done():
+                            method_stats.record(primary, time.monotonic() - started, ok=False)
+                    result["routing"] = routing
+                    return result
+                print(f"auto: {method} 未得到有效回答")
+                last_error = QueryError(f"{method}处理失败: {result['answer']}", kind="upstream")
             
-        except Exception as e:
-            return f"{method}处理失败: {str(e)}"
+            if not launched(fallback) and (not pending or time.monotonic() >= deadline):
+                future = launch(fallback, inline=not pending)
+                if future is not None:
+                    routing["hedged"] = True
+                    print(f"auto: 启动备选方法 {fallback}")
+                    pending.add(future)
+    finally:
+        # 返回、失败或被取消时都停止仍在运行的查询
+        cancel_all()
+    
+    raise last_error or QueryError("auto处理失败: 所有方法均未得到有效回答", kind="upstream")
+
+def format_result(result):
+    """将结构化结果格式化为界面展示的文本"""
+    if result["method"] == "nova_titan":
+        search_results = "\n相关性最强的前5条记录：\n"
+        for hit in result["documents"]:
+            search_results += f"\n记录索引：{hit['index']}, 距离：{hit['score']:.4f}\n"
+            search_results += f"文档内容：{hit['doc']}\n"
             
+    elif result["method"] == "nova_cohere":
+        search_results = "\n相关性最强的前5条记录：\n"
+        for hit in result["documents"]:
+            search_results += f"\n记录索引：{hit['index']}, 相关性得分：{hit['score']:.4f}\n"
+            search_results += f"文档内容：{hit['doc']}\n"
+            
+    else:  # deepseek_cohere
+        search_results = "\n相关文档检索结果：\n"
+        for count, hit in enumerate(result["documents"], 1):
+            search_results += f"\n{count}. 相关性得分：{hit['score']:.4f}\n"
+            search_results += f"   文档内容：{hit['doc']}\n"
+            
+        return f"""检索到的相关文档：
+{search_results}
+----------------------------------------
+{result["answer"]}"""
+    
+    # 其他方法保持原有的输出格式
+    return f"{search_results}\n\n最终答案：\n{result['answer']}"
+
+# 各方法的延迟和失败率，供 auto 方法路由
+method_stats = MethodStats()
+# 对冲查询在取消后仍可能短暂运行，用槽位限制总数，线程池因此不会排队
+_hedge_executor = ThreadPoolExecutor(max_workers=ROUTER_HEDGE_WORKERS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(ROUTER_HEDGE_WORKERS)
+
+def process_query(keyword, question, method="nova_cohere"):
+    """处理用户查询"""
+    try:
+        return format_result(run_query(keyword, question, method))
+    except QueryError as e:
+        return str(e)
+
+# 预热状态，供健康检查接口使用
+_ready = threading.Event()
+_warmup_status = {"status": "starting"}
+
+def parse_canary_queries(spec):
+    """解析预热查询配置：关键词|问题|方法，多条用分号分隔，方法可省略"""
+    canaries = []
+    for item in spec.split(";"):
+        parts = [part.strip() for part in item.split("|")]
+        if len(parts) < 2 or not parts[0] or not parts[1]:
+            continue
+        method = parts[2] if len(parts) > 2 and parts[2] else "nova_cohere"
+        canaries.append((parts[0], parts[1], method))
+    return canaries
+
+def prewarm_relations(conn, relations=None):
+    """使用 pg_prewarm 把索引载入数据库缓存，返回 {关系名: 载入的块数}"""
+    with conn.cursor() as cur:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+        if not relations:
+            # 默认预热 text_embedding 上的向量索引和关键词索引
+            cur.execute("""
+            SELECT c.relname
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_am am ON am.oid = c.relam
+            WHERE i.indrelid = 'text_embedding'::regclass
+              AND am.amname IN ('ivfflat', 'hnsw', 'gin', 'gist')
+            """)
+            relations = [row[0] for row in cur.fetchall()]
+        blocks = {}
+        for relation in relations:
+            cur.execute("SELECT pg_prewarm(%s::regclass)", [relation])
+            blocks[relation] = cur.fetchone()[0]
+        return blocks
+
+def warm_up():
+    """启动预热：创建客户端和连接池、预热索引缓存、执行预热查询，完成后标记为就绪"""
+    global _warmup_status
+    status = {"status": "warming"}
+    _warmup_status = status
+    start = time.perf_counter()
+    
+    cohere_client, _, _, _ = create_clients()
+    if not cohere_client:
+        status.update(status="failed", error="AWS服务连接失败")
+        return status
+    
+    try:
+        pool = get_db_pool()
+        # 同时借出最小数量的连接，确认每个连接都可用
+        with ExitStack() as stack:
+            conns = [stack.enter_context(pool.connection()) for _ in range(max(DB_POOL_MIN, 1))]
+            for conn in conns:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            status["db_connections"] = len(conns)
     except Exception as e:
-        return f"处理查询时出错: {str(e)}"
+        print(f"数据库连接失败: {str(e)}")
+        status.update(status="failed", error=f"数据库连接失败: {str(e)}")
+        return status
+    
+    try:
+        with pool.connection() as conn:
+            status["prewarm"] = prewarm_relations(conn, WARMUP_PREWARM_RELATIONS)
+        print(f"索引预热完成: {status['prewarm']}")
+    except Exception as e:
+        # 缺少 pg_prewarm 权限时不影响服务启动
+        print(f"索引预热失败: {str(e)}")
+        status["prewarm_error"] = str(e)
+    
+    canaries = []
+    for keyword, question, method in parse_canary_queries(WARMUP_CANARY_QUERIES):
+        try:
+            result = run_query(keyword, question, method)
+            canaries.append({"keyword": keyword, "method": method, "ok": True, "timings": result["timings"]})
+        except Exception as e:
+            print(f"预热查询失败 {keyword}/{method}: {str(e)}")
+            canaries.append({"keyword": keyword, "method": method, "ok": False, "error": str(e)})
+    status["canaries"] = canaries
+    
+    status.update(status="ready", elapsed=round(time.perf_counter() - start, 4))
+    _ready.set()
+    print(f"预热完成，耗时 {status['elapsed']} 秒")
+    return status
+
+def warm_up_until_ready(interval=30):
+    """预热失败（如数据库暂不可用）时定期重试，直到就绪"""
+    while warm_up()["status"] != "ready":
+        time.sleep(interval)
+
+def is_ready():
+    return _ready.is_set()
+
+def health_status():
+    """健康检查结果：预热完成前 status 为 warming 或 failed"""
+    return dict(_warmup_status)
+
+def mark_ready():
+    """跳过预热时直接标记为就绪"""
+    _warmup_status.update(status="ready")
+    _ready.set()
 
 def create_interface():
     with gr.Blocks(title="医学知识查询系统") as demo:
         gr.Markdown("# 医学知识查询系统")
-        gr.Markdown("## 支持三种查询方法")
+        gr.Markdown("## 支持三种查询方法及自动选择")
         
         with gr.Row():
             keyword = gr.Textbox(label="请输入关键词（如：发烧、感冒等）")
             question = gr.Textbox(label="请输入您的具体问题")
         
         method = gr.Radio(
-            choices=["nova_cohere", "nova_titan", "deepseek_cohere"],
+            choices=QUERY_METHODS + [AUTO_METHOD],
             value="nova_cohere",
             label="选择查询方法",
-            info="Nova+Cohere: 更精确的重排序; Nova+Titan: 更快的向量相似度; Deepseek+Cohere: 结构化专业分析"
+            info="Nova+Cohere: 更精确的重排序; Nova+Titan: 更快的向量相似度; Deepseek+Cohere: 结构化专业分析; Auto: 根据问题和各方法实时表现自动选择"
         )
         
         submit_btn = gr.Button("提交查询")
@@ -389,11 +861,23 @@ def create_interface():
 
 # 启动应用
 if __name__ == "__main__":
+    # 预热完成后再开始监听，避免冷启动的请求被路由进来
+    if WARMUP_ENABLED:
+        if warm_up()["status"] != "ready":
+            threading.Thread(target=warm_up_until_ready, daemon=True).start()
+    else:
+        mark_ready()
     demo = create_interface()
     # 获取环境变量中配置的允许访问的IP
     allowed_ip = os.getenv("ALLOWED_HOST", "127.0.0.1")  # 默认只允许本地访问
     demo.launch(
         server_name=allowed_ip,
         server_port=7860,
-        auth=(os.getenv("BASIC_AUTH_USER"), os.getenv("BASIC_AUTH_PASS"))  # 基本认证
-    ) 
\ No newline at end of file
+        auth=(os.getenv("BASIC_AUTH_USER"), os.getenv("BASIC_AUTH_PASS")),  # 基本认证
+        prevent_thread_lock=True
+    )
+    # 健康检查接口不需要认证，供负载均衡器探测
+    def health():
+        return JSONResponse(status_code=200 if is_ready() else 503, content=health_status())
+    demo.app.add_api_route("/health", health, methods=["GET"])
+    demo.block_thread()
\ No newline at end of file
@@ -23,3 +23,32 @@ DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_PORT = os.getenv("DB_PORT", "5432")
+
+# 连接池配置
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+
+# Bedrock客户端配置
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+BEDROCK_CONNECT_TIMEOUT = int(os.getenv("BEDROCK_CONNECT_TIMEOUT", "10"))
+BEDROCK_READ_TIMEOUT = int(os.getenv("BEDROCK_READ_TIMEOUT", "60"))
+
+# API服务配置
+API_MAX_CONCURRENCY = int(os.getenv("API_MAX_CONCURRENCY", "32"))
+API_REQUEST_TIMEOUT = float(os.getenv("API_REQUEST_TIMEOUT", "120"))
+
+# 启动预热配置
+WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+# 需要 pg_prewarm 的表或索引，逗号分隔；为空时自动选择 text_embedding 上的向量和关键词索引
+WARMUP_PREWARM_RELATIONS = [r.strip() for r in os.getenv("WARMUP_PREWARM_RELATIONS", "").split(",") if r.strip()]
+# 预热查询，格式：关键词|问题|方法，多条用分号分隔
+WARMUP_CANARY_QUERIES = os.getenv("WARMUP_CANARY_QUERIES", "")
+
+# auto 方法路由配置
+ROUTER_HEDGE_ENABLED = os.getenv("ROUTER_HEDGE_ENABLED", "false").lower() == "true"
+# 首选方法超过该时间（秒）未返回时启动备选方法
+ROUTER_HEDGE_DELAY = float(os.getenv("ROUTER_HEDGE_DELAY", "8"))
+# 对冲线程数上限，也是 auto 方法在 API_MAX_CONCURRENCY 之外最多额外运行的查询数
+ROUTER_HEDGE_WORKERS = int(os.getenv("ROUTER_HEDGE_WORKERS", "16"))
+ROUTER_MAX_FAILURE_RATE = float(os.getenv("ROUTER_MAX_FAILURE_RATE", "0.5"))
+ROUTER_LATENCY_BUDGET = float(os.getenv("ROUTER_LATENCY_BUDGET", "30"))
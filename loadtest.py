@@ -0,0 +1,559 @@
+# -*- coding: utf-8 -*-
+'''
+# 压测工具：按开环到达速率回放查询流，统计吞吐、延迟分布、连接池饱和度和拐点
+# 回放录制的查询（JSONL，每行 keyword/question/method，可选 offset 秒）:
+#   python loadtest.py -t process_query -w queries.jsonl --rates 5,10,20,40 --duration 60
+# 使用本地Bedrock模拟和本地Postgres（先写入合成数据）:
+#   DB_HOST=localhost python loadtest.py -t process_query --mock --seed 20000 --rates 10,20,40,80
+# 压测HTTP接口（不指定 --url 时在本进程内启动 api.py）:
+#   python loadtest.py -t http --url http://10.0.0.5:8000/query --rates 50,100,200
+'''
+
+import argparse
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+import app
+
+# 合成查询使用的关键词和问题
+SYNTHETIC_QUERIES = [
+    ("发烧", "发烧39度以上怎么处理？"),
+    ("感冒", "感冒的早期症状有哪些？"),
+    ("腹泻", "急性腹泻的治疗方法有哪些？"),
+    ("头痛", "经常头痛是什么原因，应该如何预防？"),
+    ("咳嗽", "咳嗽一直不好怎么办？"),
+    ("高血压", "高血压患者日常需要注意什么？"),
+    ("糖尿病", "糖尿病的早期表现"),
+    ("失眠", "长期失眠的原因和处理方法"),
+]
+
+# 延迟直方图的桶边界（秒）
+HISTOGRAM_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+
+def args_parse():
+    parser = argparse.ArgumentParser(description='open-loop load test for the medical search')
+    parser.add_argument('--target', '-t', help='process_query, cli (words_embedding search) or http', required=False, default='process_query')
+    parser.add_argument('--workload', '-w', help='recorded workload JSONL (keyword, question, method, optional offset); synthetic if omitted', required=False)
+    parser.add_argument('--methods', help='method mix for synthetic workload, e.g. nova_cohere:0.5,nova_titan:0.3,deepseek_cohere:0.2', required=False, default='nova_cohere:0.5,nova_titan:0.3,deepseek_cohere:0.2')
+    parser.add_argument('--arrival', '-a', help='poisson, constant or recorded (use offset field of workload)', required=False, default='poisson')
+    parser.add_argument('--rates', '-r', help='offered rates (requests/sec) to step through, comma separated', required=False, default='5,10,20,40')
+    parser.add_argument('--duration', '-d', help='seconds per rate step', required=False, default=30)
+    parser.add_argument('--speedup', help='time compression for recorded arrival', required=False, default=1.0)
+    parser.add_argument('--max-workers', help='client threads, keep above rate x latency so the load stays open-loop', required=False, default=1000)
+    parser.add_argument('--url', help='query endpoint for http target; starts api.py in-process when omitted', required=False)
+    parser.add_argument('--timeout', help='http request timeout seconds', required=False, default=120)
+    parser.add_argument('--probes', '-p', help='ivfflat probes for cli target', required=False, default=10)
+    parser.add_argument('--topk', help='topk for cli target', required=False, default=2)
+    parser.add_argument('--mock', help='replace Bedrock with a local mock', action='store_true')
+    parser.add_argument('--rerank-latency', help='mock latency, fixed:S, uniform:A:B or lognormal:MEDIAN:SIGMA', required=False, default='lognormal:0.3:0.4')
+    parser.add_argument('--embed-latency', help='mock Titan embedding latency', required=False, default='lognormal:0.15:0.3')
+    parser.add_argument('--nova-latency', help='mock Nova generation latency', required=False, default='lognormal:3:0.5')
+    parser.add_argument('--deepseek-latency', help='mock Deepseek generation latency', required=False, default='lognormal:15:0.6')
+    parser.add_argument('--throttle-rate', help='probability that a mock call is throttled', required=False, default=0.0)
+    parser.add_argument('--bedrock-concurrency', help='mock quota: concurrent calls above this are throttled, 0 = unlimited', required=False, default=0)
+    parser.add_argument('--seed', help='create text_embedding in the local Postgres and insert N synthetic rows', required=False)
+    parser.add_argument('--force', help='allow --seed to truncate a text_embedding table that already has rows', action='store_true')
+    parser.add_argument('--knee-throughput', help='knee when throughput falls below this fraction of the offered rate', required=False, default=0.9)
+    parser.add_argument('--knee-latency', help='knee when p99 exceeds this multiple of the first step p99', required=False, default=3.0)
+    parser.add_argument('--output', '-o', help='write the report as JSON', required=False)
+    return parser.parse_args()
+
+def parse_latency(spec):
+    """解析延迟分布，返回采样函数（秒）"""
+    parts = spec.split(':')
+    kind, values = parts[0], [float(v) for v in parts[1:]]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    sys.exit('ERROR: unknown latency distribution {0}'.format(spec))
+
+class MockBedrockClient:
+    """
+    本地Bedrock模拟，按请求体区分 rerank / embedding / Nova / Deepseek 调用，
+    按配置的分布休眠后返回与真实接口相同结构的响应
+    """
+
+    def __init__(self, rerank_latency, embed_latency, nova_latency, deepseek_latency,
+                 throttle_rate=0.0, max_concurrency=0, dim=1536):
+        self.latency = {
+            'rerank': rerank_latency,
+            'embed': embed_latency,
+            'nova': nova_latency,
+            'deepseek': deepseek_latency,
+        }
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.dim = dim
+        self._lock = threading.Lock()
+        self.inflight = 0
+        self.calls = 0
+        self.throttled = 0
+
+    def _throttle(self, operation):
+        with self._lock:
+            self.throttled += 1
+        raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Too many requests (mock)'}}, operation)
+
+    def invoke_model(self, modelId, body, **kwargs):
+        request = json.loads(body)
+        if 'documents' in request:
+            kind = 'rerank'
+        elif 'inputText' in request:
+            kind = 'embed'
+        elif 'prompt' in request:
+            kind = 'deepseek'
+        else:
+            kind = 'nova'
+        self._acquire('InvokeModel')
+        try:
+            time.sleep(self.latency[kind]())
+            return {'body': MockBody(self._response(kind, request))}
+        finally:
+            self._release()
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        """流式调用：生成耗时分摊到多个分块，关闭事件流后停止生成"""
+        request = json.loads(body)
+        kind = 'deepseek' if 'prompt' in request else 'nova'
+        self._acquire('InvokeModelWithResponseStream')
+        response = self._response(kind, request)
+        if kind == 'deepseek':
+            text = response['generation']
+            chunks = [{'generation': text[i:i + 20]} for i in range(0, len(text), 20)]
+        else:
+            text = response['output']['message']['content'][0]['text']
+            chunks = [{'contentBlockDelta': {'delta': {'text': ch}}} for ch in text]
+        return {'body': MockEventStream(chunks, self.latency[kind](), self._release)}
+
+    def _acquire(self, operation):
+        # 配额和随机限流在同一个锁内判断，被限流的调用不占用在途计数
+        with self._lock:
+            self.calls += 1
+            throttled = (self.max_concurrency and self.inflight >= self.max_concurrency) \
+                or random.random() < self.throttle_rate
+            if not throttled:
+                self.inflight += 1
+        if throttled:
+            self._throttle(operation)
+
+    def _release(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def _response(self, kind, request):
+        if kind == 'rerank':
+            scores = sorted((random.random() for _ in request['documents']), reverse=True)
+            indices = random.sample(range(len(request['documents'])), len(request['documents']))
+            return {'results': [{'index': i, 'relevance_score': s} for i, s in zip(indices, scores)]}
+        if kind == 'embed':
+            return {'embedding': np.random.random(self.dim).tolist(), 'inputTextTokenCount': len(request['inputText'])}
+        if kind == 'deepseek':
+            sections = ['### %d. 模拟章节\n模拟内容' % i for i in range(1, 6)]
+            return {'generation': '\n\n'.join(sections)}
+        return {'output': {'message': {'content': [{'text': '模拟回答'}]}}}
+
+    def stats(self):
+        with self._lock:
+            return {'inflight': self.inflight, 'calls': self.calls, 'throttled': self.throttled}
+
+class MockEventStream:
+    """模拟 invoke_model_with_response_stream 返回的事件流"""
+
+    def __init__(self, chunks, latency, on_finish):
+        self._chunks = chunks
+        self._delay = latency / max(len(chunks), 1)
+        self._on_finish = on_finish
+        self._closed = False
+        self._finished = False
+        # close() 在取消监视线程上调用，生成器结束在调用方线程上，需加锁保证只释放一次
+        self._finish_lock = threading.Lock()
+
+    def __iter__(self):
+        try:
+            for chunk in self._chunks:
+                time.sleep(self._delay)
+                if self._closed:
+                    raise IOError('event stream closed (mock)')
+                yield {'chunk': {'bytes': json.dumps(chunk, ensure_ascii=False).encode('utf-8')}}
+        finally:
+            self._finish()
+
+    def close(self):
+        self._closed = True
+        self._finish()
+
+    def _finish(self):
+        with self._finish_lock:
+            if self._finished:
+                return
+            self._finished = True
+        self._on_finish()
+
+class MockBody:
+
+    def __init__(self, payload):
+        self._data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+    def read(self):
+        return self._data
+
+def load_workload(path):
+    """读取录制的查询流，每行 keyword/question/method，可选 offset（秒）"""
+    queries = []
+    with open(path, encoding='utf8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            queries.append({
+                'keyword': record['keyword'],
+                'question': record['question'],
+                'method': record.get('method', 'nova_cohere'),
+                'offset': record.get('offset'),
+            })
+    if not queries:
+        sys.exit('ERROR: workload {0} is empty'.format(path))
+    return queries
+
+def parse_mix(spec):
+    methods, weights = [], []
+    for item in spec.split(','):
+        method, _, weight = item.partition(':')
+        methods.append(method.strip())
+        weights.append(float(weight or 1))
+    return methods, weights
+
+def synthetic_query(methods, weights):
+    keyword, question = random.choice(SYNTHETIC_QUERIES)
+    return {'keyword': keyword, 'question': question, 'method': random.choices(methods, weights)[0], 'offset': None}
+
+def arrival_schedule(arrival, rate, duration, workload, speedup):
+    """生成 (到达时间, 查询) 列表，到达时间相对于本轮开始（秒）"""
+    schedule = []
+    if arrival == 'recorded':
+        base = workload[0]['offset'] or 0
+        for query in workload:
+            offset = ((query['offset'] or 0) - base) / speedup
+            if offset > duration:
+                break
+            schedule.append((offset, query))
+        return schedule
+    t = 0.0
+    index = 0
+    while True:
+        t += random.expovariate(rate) if arrival == 'poisson' else 1.0 / rate
+        if t > duration:
+            return schedule
+        schedule.append((t, workload[index % len(workload)] if workload else None))
+        index += 1
+
+def seed_local_db(rows, force=False, dim=1536):
+    """
+    在本地Postgres中创建 text_embedding 并写入合成数据，只允许本地地址；
+    表中已有数据时（例如本地保存的真实语料）除非指定 force，否则拒绝覆盖
+    """
+    if app.DB_HOST not in ('localhost', '127.0.0.1', '::1'):
+        sys.exit('ERROR: --seed only runs against a local Postgres, DB_HOST is {0}'.format(app.DB_HOST))
+    keywords = [keyword for keyword, _ in SYNTHETIC_QUERIES]
+    with app.get_db_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute("""
+            CREATE TABLE IF NOT EXISTS text_embedding (
+                id int PRIMARY KEY,
+                doc_type int,
+                doc text,
+                embedding_doc vector(%s) null,
+                keywords text null
+            )
+            """ % int(dim))
+            cur.execute("SELECT EXISTS (SELECT 1 FROM text_embedding)")
+            if cur.fetchone()[0]:
+                if not force:
+                    sys.exit('ERROR: text_embedding already has rows, pass --force to replace them with synthetic data')
+                cur.execute("TRUNCATE text_embedding")
+            # 向量在数据库端生成，避免客户端占用内存
+            cur.execute("""
+            INSERT INTO text_embedding (id, doc_type, doc, embedding_doc)
+            SELECT g, 1,
+                   (%s::text[])[1 + g %% %s] || '相关的模拟医学文档 ' || g,
+                   (SELECT array_agg(random() + g * 0) FROM generate_series(1, %s))::vector
+            FROM generate_series(1, %s) AS g
+            """, (keywords, len(keywords), int(dim), int(rows)))
+    print("seeded %d synthetic rows into text_embedding" % int(rows))
+
+def start_local_api():
+    """在本进程内启动 api.py，使Bedrock模拟对HTTP目标同样生效"""
+    import uvicorn
+    import api
+
+    api.WARMUP_ENABLED = False
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(api.app, host='127.0.0.1', port=port, log_level='warning'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return 'http://127.0.0.1:%d/query' % port
+
+def make_target(args, mock=None):
+    """返回 (执行函数, 饱和度采样函数)，执行函数返回 ok / error / rejected"""
+    if args.target == 'process_query':
+        def sample():
+            return app.db_pool_stats() or {}
+        def run(query):
+            try:
+                result = app.run_query(query['keyword'], query['question'], query['method'])
+            except app.QueryError:
+                return 'error'
+            return 'ok' if app.is_good_answer(result['answer']) else 'error'
+        return run, sample
+
+    if args.target == 'cli':
+        import words_embedding
+        if mock is not None:
+            words_embedding.client = mock
+        pool = words_embedding.PsycopgConn()
+        probes, topk = int(args.probes), int(args.topk)
+        def run(query):
+            try:
+                words_embedding.searchByWord(query['keyword'], pool, probes, topk)
+            except (Exception, SystemExit):
+                # PsycopgConn 出错时调用 sys.exit
+                return 'error'
+            return 'ok'
+        return run, lambda: {}
+
+    if args.target == 'http':
+        import requests
+        url = args.url or start_local_api()
+        health_url = url.rsplit('/', 1)[0] + '/health'
+        timeout = float(args.timeout)
+        local = threading.local()
+        def session():
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return local.session
+        def run(query):
+            try:
+                response = session().post(url, json={k: query[k] for k in ('keyword', 'question', 'method')}, timeout=timeout)
+            except requests.RequestException:
+                return 'error'
+            if response.status_code == 429:
+                return 'rejected'
+            return 'ok' if response.status_code == 200 else 'error'
+        def sample():
+            try:
+                status = requests.get(health_url, timeout=2).json()
+            except (requests.RequestException, ValueError):
+                return {}
+            return dict(status.get('db_pool') or {}, inflight=status.get('inflight'))
+        print("target: %s" % url)
+        return run, sample
+
+    sys.exit('ERROR: unknown target {0}'.format(args.target))
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+def histogram(values):
+    counts = np.histogram(values, bins=[0] + HISTOGRAM_BUCKETS + [math.inf])[0] if values else []
+    labels = ['<=%gs' % b for b in HISTOGRAM_BUCKETS] + ['>%gs' % HISTOGRAM_BUCKETS[-1]]
+    return {label: int(count) for label, count in zip(labels, counts)}
+
+def run_step(run, sample, schedule, executor, rate, span, base_latency=None):
+    """
+    开环执行一轮：按计划时间提交请求，不等待前一个请求完成；
+    延迟从计划到达时间算起，包含客户端排队时间。
+    吞吐只统计发送窗口内完成的成功请求，并扣除首个请求完成前的爬升时间；
+    backlog 只统计按 base_latency（默认取本轮p99）本应在窗口内完成却未完成的请求
+    """
+    results = []
+    results_lock = threading.Lock()
+    samples = []
+    done = threading.Event()
+
+    def sampler():
+        while not done.wait(1.0):
+            samples.append(sample())
+
+    def call(scheduled_at, query):
+        outcome = run(query)
+        finished = time.perf_counter()
+        with results_lock:
+            results.append((outcome, finished - scheduled_at, finished, scheduled_at))
+
+    sampler_thread = threading.Thread(target=sampler, daemon=True)
+    sampler_thread.start()
+    start = time.perf_counter()
+    futures = []
+    max_lag = 0.0
+    for offset, query in schedule:
+        scheduled_at = start + offset
+        delay = scheduled_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            max_lag = max(max_lag, -delay)
+        futures.append(executor.submit(call, scheduled_at, query))
+    for future in futures:
+        future.result()
+    done.set()
+    sampler_thread.join()
+
+    window_end = start + span
+    latencies = [r[1] for r in results if r[0] == 'ok']
+    outcomes = [r[0] for r in results]
+    last_finish = max((r[2] for r in results), default=window_end)
+    drain = last_finish - window_end
+
+    # 稳态吞吐：窗口内、最短延迟之后完成的成功请求数 / 对应时长
+    ramp = min(latencies) if latencies else 0.0
+    measured = span - ramp
+    completed = sum(1 for r in results if r[0] == 'ok' and start + ramp <= r[2] <= window_end)
+    if measured > 0 and completed:
+        throughput = completed / measured
+    else:
+        # 窗口短于单个请求延迟时，退化为全部成功数 / 总耗时
+        throughput = len(latencies) / (last_finish - start) if last_finish > start else 0.0
+
+    if base_latency is None:
+        base_latency = percentile(latencies, 99) or 0.0
+    backlog = sum(1 for r in results if r[3] + base_latency <= window_end < r[2])
+    return {
+        'offered_rate': rate,
+        'sent': len(schedule),
+        'ok': outcomes.count('ok'),
+        'error': outcomes.count('error'),
+        'rejected': outcomes.count('rejected'),
+        'throughput': round(throughput, 3),
+        'backlog': backlog,
+        'drain': round(max(drain, 0.0), 3),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+        'histogram': histogram(latencies),
+        'dispatch_lag': round(max_lag, 4),
+        'saturation': summarize_samples(samples),
+    }
+
+def summarize_samples(samples):
+    """汇总连接池 / 在途请求的采样，给出平均值和峰值"""
+    summary = {}
+    for key in ('in_use', 'waiting', 'inflight', 'bedrock_inflight'):
+        values = [row[key] for row in samples if row.get(key) is not None]
+        if values:
+            summary[key] = {'avg': round(sum(values) / len(values), 2), 'peak': max(values)}
+    pool_max = [row['max'] for row in samples if row.get('max')]
+    if pool_max:
+        summary['pool_max'] = pool_max[-1]
+    return summary
+
+def find_knee(steps, throughput_ratio, latency_factor):
+    """
+    拐点为第一个满足以下任一条件的速率：成功吞吐低于目标速率的给定比例（出错或被拒绝）；
+    p99超过首轮p99的数倍；窗口结束后的排空时间超过首轮p99的数倍（请求在排队积压）
+    """
+    base_p99 = steps[0]['p99'] if steps else None
+    for step in steps:
+        if step['throughput'] < throughput_ratio * step['offered_rate']:
+            return step['offered_rate']
+        if base_p99 and step['p99'] is not None and step['p99'] > latency_factor * base_p99:
+            return step['offered_rate']
+        if base_p99 and step['drain'] > latency_factor * base_p99:
+            return step['offered_rate']
+    return None
+
+def fmt(value):
+    return '-' if value is None else '%.3f' % value
+
+def print_report(steps, knee):
+    print('\n' + 'load test report'.center(100, '*'))
+    print('%8s %6s %6s %6s %8s %10s %8s %8s %8s %8s %8s %8s %10s %10s' % (
+        'rate', 'sent', 'ok', 'error', 'rejected', 'throughput', 'p50', 'p90', 'p99', 'max', 'backlog', 'drain', 'pool_peak', 'waiting'))
+    for step in steps:
+        saturation = step['saturation']
+        print('%8g %6d %6d %6d %8d %10.3f %8s %8s %8s %8s %8d %8s %10s %10s' % (
+            step['offered_rate'], step['sent'], step['ok'], step['error'], step['rejected'], step['throughput'],
+            fmt(step['p50']), fmt(step['p90']), fmt(step['p99']), fmt(step['max']), step['backlog'], fmt(step['drain']),
+            saturation.get('in_use', {}).get('peak', '-'), saturation.get('waiting', {}).get('peak', '-')))
+    for step in steps:
+        print('\nlatency histogram @ %g req/s' % step['offered_rate'])
+        total = sum(step['histogram'].values()) or 1
+        for label, count in step['histogram'].items():
+            print('  %8s %6d %s' % (label, count, '#' * int(50 * count / total)))
+    if knee is None:
+        print('\nno knee found, the highest rate was sustained')
+    else:
+        sustained = [s['offered_rate'] for s in steps if s['offered_rate'] < knee]
+        print('\nknee at %g req/s, last sustained rate: %s' % (knee, sustained[-1] if sustained else '-'))
+
+if __name__ == "__main__":
+    args = args_parse()
+    rates = [float(r) for r in args.rates.split(',')]
+    duration = float(args.duration)
+
+    mock = None
+    if args.mock:
+        mock = MockBedrockClient(
+            parse_latency(args.rerank_latency),
+            parse_latency(args.embed_latency),
+            parse_latency(args.nova_latency),
+            parse_latency(args.deepseek_latency),
+            throttle_rate=float(args.throttle_rate),
+            max_concurrency=int(args.bedrock_concurrency))
+        app._clients = (mock, mock, mock, mock)
+    if args.seed:
+        seed_local_db(int(args.seed), args.force)
+
+    workload = load_workload(args.workload) if args.workload else None
+    if args.arrival == 'recorded' and not workload:
+        sys.exit('ERROR: recorded arrival needs --workload with offset fields')
+    methods, weights = parse_mix(args.methods)
+    run, target_sample = make_target(args, mock)
+
+    def sample():
+        value = dict(target_sample())
+        if mock is not None:
+            value['bedrock_inflight'] = mock.stats()['inflight']
+        return value
+
+    steps = []
+    with ThreadPoolExecutor(max_workers=int(args.max_workers), thread_name_prefix='load') as executor:
+        for rate in rates:
+            schedule = arrival_schedule(args.arrival, rate, duration, workload, float(args.speedup))
+            schedule = [(offset, query or synthetic_query(methods, weights)) for offset, query in schedule]
+            span = duration
+            if args.arrival == 'recorded':
+                # 按录制时间回放时，实际速率由录制的时间跨度决定
+                span = schedule[-1][0] if schedule and schedule[-1][0] > 0 else duration
+                rate = round(len(schedule) / span, 3)
+            print("step: %g req/s, %d requests over %gs" % (rate, len(schedule), span))
+            base_latency = steps[0]['p99'] if steps else None
+            step = run_step(run, sample, schedule, executor, rate, span, base_latency)
+            if mock is not None:
+                step['bedrock'] = mock.stats()
+            steps.append(step)
+            if args.arrival == 'recorded':
+                break
+
+    knee = find_knee(steps, float(args.knee_throughput), float(args.knee_latency))
+    print_report(steps, knee)
+    if args.output:
+        with open(args.output, 'w', encoding='utf8') as f:
+            json.dump({'steps': steps, 'knee': knee}, f, ensure_ascii=False, indent=2)
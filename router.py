@@ -0,0 +1,94 @@
+"""auto 查询方法的路由策略
+
+根据问题特征选择首选方法，再结合各方法最近的延迟和失败率调整顺序，
+给出首选方法和对冲（hedge）时使用的备选方法。
+"""
+import threading
+import time
+
+# 没有观测数据时使用的预估延迟（秒）
+DEFAULT_LATENCY = {
+    "nova_titan": 4.0,
+    "nova_cohere": 6.0,
+    "deepseek_cohere": 25.0,
+}
+
+# 需要结构化分析（原因、预防、处理）的问题关键词
+ANALYSIS_KEYWORDS = ["原因", "为什么", "预防", "治疗", "怎么办", "如何处理", "怎么处理", "注意"]
+
+class MethodStats:
+    """按方法记录延迟的指数移动平均和失败率"""
+
+    def __init__(self, alpha=0.2, ttl=60):
+        self.alpha = alpha
+        # 超过 ttl 秒没有新样本的方法视为已恢复，允许重新尝试
+        self.ttl = ttl
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, latency, ok):
+        with self._lock:
+            stats = self._stats.get(method)
+            if stats is None:
+                stats = {"latency": latency, "failure_rate": 0.0 if ok else 1.0, "count": 0}
+                self._stats[method] = stats
+            else:
+                stats["latency"] += self.alpha * (latency - stats["latency"])
+                stats["failure_rate"] += self.alpha * ((0.0 if ok else 1.0) - stats["failure_rate"])
+            stats["count"] += 1
+            stats["updated"] = time.monotonic()
+
+    def get(self, method):
+        """返回方法的统计数据，没有数据或数据已过期时返回 None"""
+        with self._lock:
+            stats = self._stats.get(method)
+            if stats is None or time.monotonic() - stats["updated"] > self.ttl:
+                return None
+            return dict(stats)
+
+    def expected_latency(self, method):
+        stats = self.get(method)
+        if stats is None:
+            return DEFAULT_LATENCY.get(method, 10.0)
+        return stats["latency"]
+
+    def snapshot(self):
+        with self._lock:
+            return {method: {k: v for k, v in stats.items() if k != "updated"}
+                    for method, stats in self._stats.items()}
+
+def preferred_methods(question, methods):
+    """根据问题特征给出方法的偏好顺序"""
+    question = question.strip()
+    if any(keyword in question for keyword in ANALYSIS_KEYWORDS) and len(question) >= 12:
+        # 较长的分析类问题适合 Deepseek 的结构化回答
+        first = "deepseek_cohere"
+    elif len(question) <= 8:
+        # 简短问题用向量相似度即可
+        first = "nova_titan"
+    else:
+        first = "nova_cohere"
+    ordered = [first] if first in methods else []
+    return ordered + [method for method in methods if method != first]
+
+def choose_methods(question, stats, methods, max_failure_rate=0.5, latency_budget=30.0):
+    """返回 (首选方法, 备选方法)
+
+    失败率超过 max_failure_rate 或平均延迟超过 latency_budget 的方法排到最后；
+    备选方法取其余健康方法中预估延迟最低的一个。
+    """
+    def healthy(method):
+        method_stats = stats.get(method)
+        if method_stats is None:
+            return True
+        return method_stats["failure_rate"] <= max_failure_rate and method_stats["latency"] <= latency_budget
+
+    ordered = preferred_methods(question, methods)
+    ordered = [m for m in ordered if healthy(m)] + [m for m in ordered if not healthy(m)]
+    primary = ordered[0]
+    rest = ordered[1:]
+    if not rest:
+        return primary, None
+    healthy_rest = [m for m in rest if healthy(m)] or rest
+    fallback = min(healthy_rest, key=stats.expected_latency)
+    return primary, fallback
@@ -18,6 +18,7 @@ import datetime
 import pytz
 import math
 import os
+import numpy as np
 from dotenv import load_dotenv
 
 # 加载环境变量
@@ -33,11 +34,13 @@ dbname = os.getenv("DB_NAME")
 
 def args_parse():
     parser = argparse.ArgumentParser(description='search test by vector')
-    parser.add_argument('--mode', '-m', help='embedding: update embedding, search: search a keyword, mandatory', required=True, default='search')
+    parser.add_argument('--mode', '-m', help='embedding: update embedding, search: search a keyword, export/import: embedding snapshot, mandatory', required=True, default='search')
     parser.add_argument('--probes', '-p', help='probes for vectors search, optional', required=False, default=10)
     parser.add_argument('--topk', '-t', help='topk', required=False, default=2)
     parser.add_argument('--input', '-i', help='word to search', required=False)
     parser.add_argument('--maxId', '-r', help='rows to embedding, default 226272, which is same with test data', required=False)
+    parser.add_argument('--file', '-f', help='snapshot file for export/import, .parquet or .npy (ids saved to <name>.ids.npy)', required=False)
+    parser.add_argument('--batch', '-b', help='rows per batch for export/import', required=False, default=5000)
     args = parser.parse_args()
     return args
 
@@ -293,6 +296,165 @@ def searchRc(input_word: str, pool, probes: int = 10, topk: int = 2):
         print(doc)
     return
 
+def snapshotFormat(path: str):
+    if path.endswith('.parquet'):
+        return 'parquet'
+    if path.endswith('.npy'):
+        return 'npy'
+    sys.exit('ERROR: snapshot file must end with .parquet or .npy: {0}'.format(path))
+
+def idsPath(path: str):
+    return path[:-len('.npy')] + '.ids.npy'
+
+def iterEmbeddingBatches(cursor, batch: int):
+    """
+    fetch (ids, embeddings) batches from a server-side cursor
+    :return: generator of (int64 array, float32 matrix)
+    """
+    while True:
+        rows = cursor.fetchmany(batch)
+        if not rows:
+            break
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        # 向量文本格式为 [x1,x2,...]，直接由numpy解析
+        embeddings = np.stack([np.fromstring(row[1][1:-1], dtype=np.float32, sep=',') for row in rows])
+        yield ids, embeddings
+
+# export embeddings to a parquet file or a .npy memmap, memory bounded by batch size
+def exportEmbeddings(pool, path: str, batch: int = 5000):
+    fmt = snapshotFormat(path)
+    conn = pool.get_pool_conn()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        # 计数和导出在同一个快照中，保证行数一致
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor.execute("select count(*), max(vector_dims(embedding_doc)) from text_embedding where embedding_doc is not null")
+        total, dim = cursor.fetchone()
+        cursor.close()
+        if not total:
+            sys.exit('ERROR: no embeddings to export')
+        # 服务端游标，每次只取一批
+        cursor = conn.cursor(name='embedding_export')
+        cursor.execute("select id, embedding_doc::text from text_embedding where embedding_doc is not null order by id")
+        start_time = datetime.datetime.now(tz)
+        if fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([('id', pa.int64()), ('embedding', pa.list_(pa.float32(), dim))])
+            with pq.ParquetWriter(path, schema) as writer:
+                for ids, embeddings in iterEmbeddingBatches(cursor, batch):
+                    vectors = pa.FixedSizeListArray.from_arrays(pa.array(embeddings.ravel()), dim)
+                    writer.write_table(pa.Table.from_arrays([pa.array(ids), vectors], schema=schema))
+        else:
+            vectors = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(total, dim))
+            id_list = np.lib.format.open_memmap(idsPath(path), mode='w+', dtype=np.int64, shape=(total,))
+            offset = 0
+            for ids, embeddings in iterEmbeddingBatches(cursor, batch):
+                vectors[offset:offset + len(ids)] = embeddings
+                id_list[offset:offset + len(ids)] = ids
+                offset += len(ids)
+            vectors.flush()
+            id_list.flush()
+            del vectors, id_list
+        end_time = datetime.datetime.now(tz)
+        print("export %d embeddings (dim %d) to %s, time: %d sec" % (total, dim, path, math.ceil((end_time - start_time).total_seconds())))
+    except Exception as e:
+        sys.exit('ERROR: export embeddings error caused {0}'.format(str(e)))
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.commit()
+        conn.close()
+    return total
+
+def readEmbeddingBatches(path: str, batch: int):
+    """
+    read (ids, embeddings) batches from a snapshot file
+    :return: generator of (int64 array, float32 matrix)
+    """
+    if snapshotFormat(path) == 'parquet':
+        import pyarrow.parquet as pq
+        for record_batch in pq.ParquetFile(path).iter_batches(batch_size=batch):
+            ids = record_batch.column(0).to_numpy()
+            vectors = record_batch.column(1)
+            dim = vectors.type.list_size
+            embeddings = vectors.flatten().to_numpy().reshape(-1, dim)
+            yield ids, embeddings
+    else:
+        vectors = np.load(path, mmap_mode='r')
+        id_list = np.load(idsPath(path), mmap_mode='r')
+        for offset in range(0, len(id_list), batch):
+            yield id_list[offset:offset + batch], vectors[offset:offset + batch]
+
+class CopyStream:
+    """
+    file-like object feeding binary COPY data batch by batch, used by copy_expert
+    row layout: field count, id (int4), vector (int2 dim, int2 unused, float4 * dim)
+    """
+
+    def __init__(self, batches):
+        self._batches = batches
+        self._buffer = b'PGCOPY\n\xff\r\n\x00' + np.array([0, 0], dtype='>i4').tobytes()
+        self._offset = 0
+        self._finished = False
+
+    def encode(self, ids, embeddings):
+        dim = embeddings.shape[1]
+        row_type = np.dtype([('fields', '>i2'), ('id_len', '>i4'), ('id', '>i4'), ('vec_len', '>i4'),
+                             ('dim', '>i2'), ('unused', '>i2'), ('vec', '>f4', (dim,))])
+        rows = np.empty(len(ids), dtype=row_type)
+        rows['fields'] = 2
+        rows['id_len'] = 4
+        rows['id'] = ids
+        rows['vec_len'] = 4 + 4 * dim
+        rows['dim'] = dim
+        rows['unused'] = 0
+        rows['vec'] = embeddings
+        return rows.tobytes()
+
+    def read(self, size=-1):
+        # 当前批次读完后再编码下一批，内存只保留一个批次
+        while self._offset >= len(self._buffer) and not self._finished:
+            try:
+                ids, embeddings = next(self._batches)
+                self._buffer = self.encode(ids, embeddings)
+            except StopIteration:
+                self._buffer = np.array([-1], dtype='>i2').tobytes()
+                self._finished = True
+            self._offset = 0
+        if size < 0:
+            size = len(self._buffer) - self._offset
+        data = self._buffer[self._offset:self._offset + size]
+        self._offset += len(data)
+        return data
+
+# import embeddings from a snapshot file with binary COPY, then update text_embedding by id
+def importEmbeddings(pool, path: str, batch: int = 5000):
+    conn = pool.get_pool_conn()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("create temp table embedding_import (id int primary key, embedding_doc vector) on commit drop")
+        start_time = datetime.datetime.now(tz)
+        cursor.copy_expert("copy embedding_import (id, embedding_doc) from stdin with (format binary)",
+                           CopyStream(readEmbeddingBatches(path, batch)), size=1024 * 1024)
+        cursor.execute("select count(*) from embedding_import")
+        total = cursor.fetchone()[0]
+        cursor.execute("update text_embedding t set embedding_doc = s.embedding_doc from embedding_import s where t.id = s.id")
+        updated = cursor.rowcount
+        conn.commit()
+        end_time = datetime.datetime.now(tz)
+        print("import %d embeddings from %s, updated %d rows, time: %d sec" % (total, path, updated, math.ceil((end_time - start_time).total_seconds())))
+    except Exception as e:
+        conn.rollback()
+        sys.exit('ERROR: import embeddings error caused {0}'.format(str(e)))
+    finally:
+        if cursor is not None:
+            cursor.close()
+        conn.close()
+    return updated
+
 # Create a Bedrock Runtime client in the AWS Region of your choice.
 client = boto3.client("bedrock-runtime", region_name="us-west-2")
 # Set the model ID, e.g., Titan Text Embeddings V2: amazon.titan-embed-text-v2:0
@@ -332,9 +494,16 @@ if __name__ == "__main__":
     topk=int(args.topk) if args.topk is not None else None
     input_word = args.input
     maxId = int(args.maxId) if args.maxId is not None else None
+    batch = int(args.batch)
+    if mode in ("export", "import") and not args.file:
+        sys.exit('ERROR: --file is required for {0} mode'.format(mode))
     pool = PsycopgConn()
     if mode == "embedding":
         batchUpdateEmbedding(pool, maxId)
     elif mode == "search":
         searchRc(input_word, pool, probes, topk)
+    elif mode == "export":
+        exportEmbeddings(pool, args.file, batch)
+    elif mode == "import":
+        importEmbeddings(pool, args.file, batch)
     pool.close_pool()